@@ -1,48 +1,104 @@
-import hashlib
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the numpy kernel below is used instead
+    njit = None
+
+# Hash field limits: freq1(10 bits) | freq2(10 bits) | time_delta(8 bits)
+FREQ_MAX = 2**10 - 1  # under 1024 bins
+DT_MAX = 2**8 - 1  # time delta is usually small
 
 def generate_hashes(peaks, track_id, fanout=7, max_time_delta=5):
     """Convert peaks into hashes by creating relationships between them.
-    
+
     Individual peaks aren't very useful but relationships are unique in songs.
-    Peaks should be pre-pruned before passing to this function."""
-    hashes = []
+    Peaks should be pre-pruned before passing to this function.
+    Takes an (N, 3) array of (freq_bin, time_frame, magnitude) rows, e.g. from extract_peaks.
+    Returns ((hashes uint32 array, anchor_times int32 array), track_id)."""
+    peaks = np.asarray(peaks, dtype=np.int32).reshape(-1, 3)
+    freqs = np.ascontiguousarray(peaks[:, 0])
+    times = np.ascontiguousarray(peaks[:, 1])
+
+    hashes, anchor_times = _pair_hashes(freqs, times, fanout, max_time_delta)
+
+    # Two parallel arrays: hashes[i] was anchored at anchor_times[i]
+    return (hashes, anchor_times), track_id  # Return track_id separately instead of storing with each hash
+
+def _pair_hashes_loop(freqs, times, fanout, max_time_delta):
+    """Hash kernel written as plain loops so numba can compile it to native code."""
     # Sorting by time so that process finds time based neighbours efficiently
-    peaks_sorted = sorted(peaks, key=lambda x: x[1])
+    order = np.argsort(times, kind="mergesort")
+    n = order.shape[0]
+
+    # At most fanout hashes per anchor, so preallocate and trim at the end
+    hashes = np.empty(n * fanout, dtype=np.uint32)
+    anchor_times = np.empty(n * fanout, dtype=np.int32)
+    count = 0
 
     # Use each peak as anchor
-    for i, anchor in enumerate(peaks_sorted):
-        anchor_freq, anchor_time, anchor_mag = anchor
-        
+    for i in range(n):
+        anchor_freq = min(freqs[order[i]], FREQ_MAX)
+        anchor_time = times[order[i]]
+
         # Limit fanout - only process up to fanout neighbours
-        neighbours_collected = 0
-        for j in range(i + 1, len(peaks_sorted)):
-            if neighbours_collected >= fanout:
-                break
-                
-            target_freq, target_time, target_mag = peaks_sorted[j]
+        for j in range(i + 1, min(i + 1 + fanout, n)):
+            time_delta = times[order[j]] - anchor_time
             # Setting time constraint because too far relationships are useless due to less accuracy
-            if target_time - anchor_time > max_time_delta:
+            if time_delta > max_time_delta:
                 break
 
-            time_delta = target_time - anchor_time
-            # Create hash from three values for uniqueness
-            hash_int = create_hash(anchor_freq, target_freq, time_delta)
-            # Store as tuple: (hash_int, anchor_time)
-            hashes.append((hash_int, int(anchor_time)))
-            neighbours_collected += 1
+            target_freq = min(freqs[order[j]], FREQ_MAX)
+            # Same bit packing as create_hash, inlined (numba folds the globals into constants)
+            hashes[count] = (anchor_freq << 18) | (target_freq << 8) | min(time_delta, DT_MAX)
+            anchor_times[count] = anchor_time
+            count += 1
 
-    return hashes, track_id  # Return track_id separately instead of storing with each hash
+    return hashes[:count], anchor_times[:count]
+
+def _pair_hashes_numpy(freqs, times, fanout, max_time_delta):
+    """Hash kernel for when numba isn't installed, all fanout offsets in one [N, fanout] pass."""
+    # Sorting by time so that neighbour k of every anchor is simply the peak k places after it
+    order = np.argsort(times, kind="stable")
+    freqs = freqs[order]
+    times = times[order].astype(np.int64)
+    n = len(times)
+
+    # Pad past the last peak with a far-future time so missing neighbours always fail the time check
+    padded_freqs = np.concatenate([freqs, np.zeros(fanout, dtype=freqs.dtype)])
+    padded_times = np.concatenate([times, np.full(fanout, np.iinfo(np.int32).max, dtype=np.int64)])
+    neighbours = np.arange(n)[:, None] + np.arange(1, fanout + 1)
+
+    time_delta = padded_times[neighbours] - times[:, None]
+    # Setting time constraint because too far relationships are useless due to less accuracy
+    valid = time_delta <= max_time_delta
+
+    freq1 = np.minimum(freqs, FREQ_MAX)[:, None]
+    freq2 = np.minimum(padded_freqs[neighbours], FREQ_MAX)
+    delta = np.minimum(time_delta, DT_MAX)
+
+    # Same bit packing as create_hash for the whole matrix, the mask keeps rows in anchor order
+    hash_matrix = (freq1 << 18) | (freq2 << 8) | delta
+    hashes = hash_matrix[valid].astype(np.uint32)
+    anchor_times = np.broadcast_to(times[:, None], valid.shape)[valid].astype(np.int32)
+
+    return hashes, anchor_times
+
+if njit is not None:
+    _pair_hashes = njit(nogil=True, cache=True)(_pair_hashes_loop)
+else:
+    _pair_hashes = _pair_hashes_numpy
 
 def create_hash(freq1, freq2, time_delta):
     """Create unique hash by combining three values into a single integer using bit packing."""
-    
+
     # Constraints to avoid overflow or too large numbers
-    freq1 = min(freq1, 2**10 - 1)  # 10 bits for frequency (under 1024 bins)
-    freq2 = min(freq2, 2**10 - 1)  
-    time_delta = min(time_delta, 2**8 - 1)  # 8 bits for time delta (usually small)
+    freq1 = min(freq1, FREQ_MAX)  # 10 bits for frequency
+    freq2 = min(freq2, FREQ_MAX)
+    time_delta = min(time_delta, DT_MAX)  # 8 bits for time delta
 
     # Bit packing: freq1(10 bits) | freq2(10 bits) | time_delta(8 bits)
     # Creates 2^28 unique possible combinations
     hash_int = (freq1 << 18) | (freq2 << 8) | time_delta
-    
-    return hex(hash_int)
+
+    return hash_int
@@ -11,6 +11,7 @@ def extract_peaks(spectrogram_db, magnitude_threshold=-25, neighborhood_size=15)
     WHY: We need stable audio landmarks that survive noise and compression.
     
     NOTE: magnitude_threshold is now in dB scale (-80 to 0), so we adjust the default
+    RETURNS: np.ndarray of shape (N, 3) with rows (freq_bin, time_frame, magnitude), sorted by time
     """
     # WHY USE LOCAL MAXIMA: To find points that stand out from their surroundings
     # This finds points brighter than all neighbors in a defined area
@@ -38,8 +39,12 @@ def extract_peaks(spectrogram_db, magnitude_threshold=-25, neighborhood_size=15)
     # This prevents duplicate hashes for the same musical event
     peaks = filter_false_peaks(peaks, spectrogram_db)
     
+    # WHY NUMPY ARRAY: generate_hashes works on arrays, so hand over (N, 3) rows of (freq_bin, time_frame, magnitude)
+    peaks = np.array(peaks, dtype=np.float32).reshape(-1, 3)
+
     # WHY SORT BY TIME: Makes subsequent hash generation sequential and efficient
-    return sorted(peaks, key=lambda x: x[1])
+    # WHY ARGSORT: C-level stable sort instead of calling a Python lambda per comparison
+    return peaks[np.argsort(peaks[:, 1], kind="stable")]
 
 def filter_false_peaks(peaks, spectrogram_db, min_freq_distance=5, min_time_distance=3):
     """
@@ -1,4 +1,5 @@
 import os, base64, time, requests
+from functools import lru_cache
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -40,6 +41,7 @@ def _get_token():
     return token
 
 
+@lru_cache(maxsize=4096)  # metadata doesnt change, so repeat lookups skip the HTTP round-trip
 def spotify_parser(track_id: str):
     """returns metadata for a spotify song\n
     **PARAMS:** track_id (spotify songID)\n
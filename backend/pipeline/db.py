@@ -1,29 +1,72 @@
+import os
 import sqlite3
+import threading
 import time
+from collections.abc import Iterator
+from itertools import repeat
 from engine.spotify_parser import spotify_parser
 
 DB_PATH = "sonique.db"
-
-
-def create_db(conn: sqlite3.Connection):
-    """create db tables if they dont exist"""
+BULK_INDEX_THRESHOLD = 5000  # batches bigger than this (and than the table) rebuild indexes instead of updating them
+FETCH_CHUNK_SIZE = 10000  # rows per fetchmany when streaming the Songs table
+ROWS_PER_INSERT = 500  # max rows per multi-row INSERT statement, capped further by rows_per_insert()
+
+# Songs indexes, kept in one place so bulk inserts can drop and rebuild them
+# covering index: the match join reads spotify_ID and hash_time straight from it without touching the table
+SONGS_INDEXES = {
+    "idx_songs_hash_covering": "CREATE INDEX IF NOT EXISTS idx_songs_hash_covering ON Songs (hash_value, spotify_ID, hash_time)",
+    "idx_hash_time": "CREATE INDEX IF NOT EXISTS idx_hash_time ON Songs (hash_time)",
+}
+
+# applied to every connection: WAL + NORMAL sync avoids an fsync per commit,
+# bigger cache/mmap keeps the hash index in memory during matching
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",  # 64 MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA busy_timeout=60000",
+]
+
+# one connection per thread, reused across calls (sqlite connections cant be shared between threads)
+_conn = threading.local()
+_db_initialized = False
+_init_lock = threading.Lock()
+# serializes writers across threads so parallel loads dont fight over the sqlite write lock
+_write_lock = threading.Lock()
+
+
+def create_db(conn: sqlite3.Connection) -> bool:
+    """create db tables if they dont exist\n
+    **RETURN:** True if the schema is in place, False if it failed (safe to retry)"""
     try:
         cursor = conn.cursor()
+        # one explicit transaction so a failed legacy migration rolls back instead of leaving Songs half-moved,
+        # IMMEDIATE takes the write lock up front (waiting on busy_timeout) since the schema checks read first
+        cursor.execute("BEGIN IMMEDIATE")
+
+        # old DBs stored hashes as hex text, move them aside so Songs is recreated with INTEGER columns
+        legacy_songs = rename_legacy_songs(cursor)
 
-        # fingerprints table (stores audio hashes)
+        # fingerprints table (stores audio hashes as packed integers)
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS Songs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 spotify_ID VARCHAR(25) NOT NULL,
                 youtube_ID VARCHAR(15) NOT NULL,
-                hash_time FLOAT NOT NULL,
-                hash_value VARCHAR(50) NOT NULL
+                hash_time INTEGER NOT NULL,
+                hash_value INTEGER NOT NULL
             )
         """
         )
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hash_value ON Songs (hash_value)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hash_time ON Songs (hash_time)")
+        if legacy_songs:
+            migrate_legacy_songs(cursor)
+        for create_index in SONGS_INDEXES.values():
+            cursor.execute(create_index)
+        # superseded by idx_songs_hash_covering
+        cursor.execute("DROP INDEX IF EXISTS idx_hash_value")
 
         # song metadata table (title, artists, cover, etc.)
         cursor.execute(
@@ -68,14 +111,66 @@ def create_db(conn: sqlite3.Connection):
         )
 
         conn.commit()
+        return True
     except sqlite3.Error as e:
         print(f"[DB ERROR] create_db failed: {e}")
+        conn.rollback()
+        return False
+
+
+def rename_legacy_songs(cursor: sqlite3.Cursor) -> bool:
+    """renames a Songs table that still uses hex VARCHAR hashes to Songs_old\n
+    **RETURN:** True if a legacy table was found"""
+    columns = {row[1]: row[2].upper() for row in cursor.execute("PRAGMA table_info(Songs)")}
+    if not columns or columns.get("hash_value") == "INTEGER":
+        return False
+
+    print("[DB] Migrating Songs.hash_value from hex text to INTEGER...")
+    cursor.execute("DROP INDEX IF EXISTS idx_hash_value")
+    cursor.execute("DROP INDEX IF EXISTS idx_hash_time")
+    cursor.execute("ALTER TABLE Songs RENAME TO Songs_old")
+    return True
+
+
+def migrate_legacy_songs(cursor: sqlite3.Cursor):
+    """copies Songs_old into the new Songs table converting hashes to integers"""
+    # INSERT ... SELECT lets sqlite stream the rows instead of loading the old table into python
+    cursor.connection.create_function("hex_to_int", 1, lambda h: int(str(h), 0), deterministic=True)
+    cursor.execute(
+        """
+        INSERT INTO Songs (id, spotify_ID, youtube_ID, hash_time, hash_value)
+        SELECT id, spotify_ID, youtube_ID, CAST(hash_time AS INTEGER), hex_to_int(hash_value)
+        FROM Songs_old
+    """
+    )
+    cursor.execute("DROP TABLE Songs_old")
 
 
 def get_connection() -> sqlite3.Connection | None:
+    """returns this thread's persistent connection, opening it (and creating tables) on first use"""
+    global _db_initialized
+
     try:
-        conn = sqlite3.connect(DB_PATH)
-        create_db(conn)
+        conn = getattr(_conn, "c", None)
+        if conn is None:
+            is_new_db = not os.path.exists(DB_PATH)
+            conn = sqlite3.connect(DB_PATH)
+            if is_new_db:
+                # page size can only change before the first table is written
+                conn.execute("PRAGMA page_size=4096")
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            _conn.c = conn
+        elif conn.in_transaction:
+            # connection outlives each call, so never hand out one left mid-write by a failed helper
+            conn.rollback()
+
+        # table/index DDL only needs to succeed once per process, a failure (e.g. db locked) is retried next call
+        if not _db_initialized:
+            with _init_lock:
+                if not _db_initialized:
+                    _db_initialized = create_db(conn)
+
         return conn
     except sqlite3.Error as e:
         print(f"[DB ERROR] Connection failed: {e}")
@@ -104,24 +199,27 @@ def song_exists(track_id: str) -> int:
         return 0
     finally:
         cursor.close()
-        conn.close()
 
 
-def save_fingerprints_batch(fingerprints: list[dict]):
+def rows_per_insert(conn: sqlite3.Connection) -> int:
+    """rows per multi-row INSERT (4 params each) that fit this sqlite build's bound-variable limit\n
+    **RETURN:** ROWS_PER_INSERT, or less on builds limited to 999 variables (sqlite < 3.32)"""
+    if hasattr(conn, "getlimit"):  # python 3.11+
+        max_variables = conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    else:
+        max_variables = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    return max(1, min(ROWS_PER_INSERT, max_variables // 4))
+
+
+def save_fingerprints_batch(track_id: str, youtube_id: str, hashes, times):
     """save fingerprints to 'Songs' table\n
-    **PARAMS:** fingerprints (list of dicts/tuples containing: spotify_ID, youtube_ID, hash_time, hash_value)
+    **PARAMS:** track_id (spotify), youtube_id, hashes, times (parallel np arrays from generate_hashes)
     """
-    if not fingerprints:
+    if len(hashes) == 0:
         return 0
 
-    query = """
-        INSERT INTO Songs (spotify_ID, youtube_ID, hash_time, hash_value)
-        VALUES (?, ?, ?, ?)
-    """
-    data = [
-        (fp["spotify_ID"], fp["youtube_ID"], fp["hash_time"], fp["hash_value"])
-        for fp in fingerprints
-    ]
+    # ids are the same for every row, only the hash columns vary
+    data = list(zip(repeat(track_id), repeat(youtube_id), times.tolist(), hashes.tolist()))
 
     conn = get_connection()
     if not conn:
@@ -130,8 +228,33 @@ def save_fingerprints_batch(fingerprints: list[dict]):
 
     try:
         cursor = conn.cursor()
-        cursor.executemany(query, data)
-        conn.commit()
+        with _write_lock:
+            # one transaction, each statement inserting chunk_size rows at once; IMMEDIATE takes the
+            # write lock before the MAX(id) read so another writer's commit cant fail us with BUSY_SNAPSHOT
+            chunk_size = rows_per_insert(conn)
+            cursor.execute("BEGIN IMMEDIATE")
+
+            # rebuilding an index once is cheaper than updating it row by row, but only
+            # while the batch outweighs what is already in the table (ids are autoincrement)
+            existing_rows = cursor.execute("SELECT COALESCE(MAX(id), 0) FROM Songs").fetchone()[0]
+            rebuild_indexes = len(data) > BULK_INDEX_THRESHOLD and len(data) >= existing_rows
+            if rebuild_indexes:
+                for index_name in SONGS_INDEXES:
+                    cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+            for start in range(0, len(data), chunk_size):
+                chunk = data[start : start + chunk_size]
+                placeholders = ", ".join(["(?, ?, ?, ?)"] * len(chunk))
+                cursor.execute(
+                    f"INSERT INTO Songs (spotify_ID, youtube_ID, hash_time, hash_value) VALUES {placeholders}",
+                    [value for row in chunk for value in row],
+                )
+
+            if rebuild_indexes:
+                for create_index in SONGS_INDEXES.values():
+                    cursor.execute(create_index)
+                cursor.execute("ANALYZE Songs")
+            conn.commit()
         print(f"[DB] Inserted {len(data)} fingerprints.")
         return len(data)
     except sqlite3.Error as e:
@@ -140,7 +263,21 @@ def save_fingerprints_batch(fingerprints: list[dict]):
         return 0
     finally:
         cursor.close()
-        conn.close()
+
+
+def analyze_db():
+    """refreshes query planner statistics, run after bulk loading songs"""
+    conn = get_connection()
+    if not conn:
+        return
+
+    try:
+        with _write_lock:
+            conn.execute("ANALYZE")
+            conn.commit()
+    except sqlite3.Error as e:
+        print(f"[DB ERROR] ANALYZE failed: {e}")
+        conn.rollback()
 
 
 def save_song_metadata(spotify_id, youtube_id, metadata):
@@ -152,30 +289,31 @@ def save_song_metadata(spotify_id, youtube_id, metadata):
 
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            INSERT OR REPLACE INTO SongMetadata
-            (spotify_ID, youtube_ID, title, artists, cover, album_name, release_date, duration_ms)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-            (
-                spotify_id,
-                youtube_id,
-                metadata.get("title", ""),
-                metadata.get("artists", ""),
-                metadata.get("cover", ""),
-                metadata.get("album_name", ""),
-                metadata.get("release_date", ""),
-                metadata.get("duration_ms", 0),
-            ),
-        )
-        conn.commit()
+        with _write_lock:
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO SongMetadata
+                (spotify_ID, youtube_ID, title, artists, cover, album_name, release_date, duration_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    spotify_id,
+                    youtube_id,
+                    metadata.get("title", ""),
+                    metadata.get("artists", ""),
+                    metadata.get("cover", ""),
+                    metadata.get("album_name", ""),
+                    metadata.get("release_date", ""),
+                    metadata.get("duration_ms", 0),
+                ),
+            )
+            conn.commit()
         print(f"[DB] Saved metadata for {spotify_id}")
     except sqlite3.Error as e:
         print(f"[DB ERROR] Failed to save metadata: {e}")
+        conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
 
 def get_song_metadata(spotify_id: str):
@@ -198,7 +336,33 @@ def get_song_metadata(spotify_id: str):
         return None
     finally:
         cursor.close()
-        conn.close()
+
+
+def get_songs_metadata(spotify_ids: list[str]) -> dict:
+    """get cached metadata for several songs in one query\n
+    **PARAMS:** spotify_ids (list of str)\n
+    **RETURN:** {spotify_ID: metadata dict} for the ids that have cached metadata"""
+    if not spotify_ids:
+        return {}
+
+    conn = get_connection()
+    if not conn:
+        return {}
+
+    try:
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" * len(spotify_ids))
+        cursor.execute(
+            f"SELECT * FROM SongMetadata WHERE spotify_ID IN ({placeholders})",
+            list(spotify_ids),
+        )
+        return {row["spotify_ID"]: dict(row) for row in cursor.fetchall()}
+    except sqlite3.Error as e:
+        print(f"[DB ERROR] get_songs_metadata failed: {e}")
+        return {}
+    finally:
+        cursor.close()
 
 
 def get_dashboard() -> list[dict]:
@@ -227,7 +391,6 @@ def get_dashboard() -> list[dict]:
         return []
     finally:
         cursor.close()
-        conn.close()
 
 
 def get_song(spotify_id: str):
@@ -287,29 +450,70 @@ def get_song(spotify_id: str):
         return None
     finally:
         cursor.close()
-        conn.close()
 
 
-def get_all_fingerprints() -> list[dict]:
-    """returns list of all fingerprints in DB"""
+def get_all_fingerprints() -> Iterator[tuple]:
+    """streams every fingerprint in DB without loading the whole table into memory\n
+    **RETURN:** iterator of (spotify_ID, hash_value, hash_time) tuples"""
     query = "SELECT spotify_ID, hash_value, hash_time FROM Songs"
 
     conn = get_connection()
     if not conn:
-        return []
+        return
 
     try:
-        conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
+        cursor.row_factory = None  # plain tuples, no per-row dict/Row objects
+        cursor.arraysize = FETCH_CHUNK_SIZE
         cursor.execute(query)
-        results = [dict(row) for row in cursor.fetchall()]
-        return results
+        while rows := cursor.fetchmany():
+            yield from rows
     except sqlite3.Error as e:
         print(f"[DB ERROR] Failed to fetch fingerprints: {e}")
-        return []
     finally:
         cursor.close()
-        conn.close()
+
+
+def get_offset_match_counts(hashes: list[int], times: list[int]) -> dict:
+    """scores every song against the sample in one query: joins the sample hashes through
+    idx_songs_hash_covering and counts how many agree on each song's most common time offset\n
+    **PARAMS:** hashes, times (parallel lists from the sample's fingerprints)\n
+    **RETURN:** {spotify_ID: num_matches}"""
+    conn = get_connection()
+    if not conn:
+        return {}
+
+    try:
+        cursor = conn.cursor()
+        # temp table lives on this thread's connection, so clear it before each query
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS QueryHashes (h INTEGER NOT NULL, t INTEGER NOT NULL)"
+        )
+        cursor.execute("DELETE FROM QueryHashes")
+        cursor.executemany("INSERT INTO QueryHashes (h, t) VALUES (?, ?)", zip(hashes, times))
+        # CROSS JOIN pins QueryHashes as the outer loop so each sample hash is one index seek,
+        # the inner GROUP BY is the offset histogram and the outer one keeps each song's peak
+        cursor.execute(
+            """
+            SELECT spotify_ID, MAX(offset_count)
+            FROM (
+                SELECT S.spotify_ID, S.hash_time - Q.t AS delta, COUNT(*) AS offset_count
+                FROM QueryHashes Q
+                CROSS JOIN Songs S ON S.hash_value = Q.h
+                GROUP BY S.spotify_ID, delta
+            )
+            GROUP BY spotify_ID
+        """
+        )
+        results = {row[0]: row[1] for row in cursor.fetchall()}
+        conn.commit()
+        return results
+    except sqlite3.Error as e:
+        print(f"[DB ERROR] Failed to match fingerprints: {e}")
+        conn.rollback()
+        return {}
+    finally:
+        cursor.close()
 
 
 def save_feedback(spotify_id, user_ip, is_correct, audio_path=None):
@@ -332,9 +536,9 @@ def save_feedback(spotify_id, user_ip, is_correct, audio_path=None):
         print(f"[DB] Saved feedback for {spotify_id}: correct={is_correct}")
     except sqlite3.Error as e:
         print(f"[DB ERROR] Failed to save feedback: {e}")
+        conn.rollback()
     finally:
         cursor.close()
-        conn.close()
 
 
 def check_rate_limit(user_ip, endpoint, max_requests=10, window_seconds=60):
@@ -369,7 +573,7 @@ def check_rate_limit(user_ip, endpoint, max_requests=10, window_seconds=60):
         return True
     except sqlite3.Error as e:
         print(f"[DB ERROR] Rate limit check failed: {e}")
+        conn.rollback()
         return True
     finally:
         cursor.close()
-        conn.close()
@@ -1,5 +1,6 @@
 import os
-from pipeline.db import save_fingerprints_batch, save_song_metadata, song_exists
+from concurrent.futures import ThreadPoolExecutor
+from pipeline.db import analyze_db, get_song, save_fingerprints_batch, save_song_metadata, song_exists
 from engine.spotify_parser import spotify_parser
 from engine.yt_scraper import yt_downloader
 from engine.preprocessor import preprocessor
@@ -18,6 +19,8 @@ def process_spotify_track(track_id: str):
     try:
         # 1: check if song already exists
         if song_exists(track_id):
+            # songs indexed before metadata was cached get it filled in once here, not on every match
+            get_song(track_id)
             print(f"[WARN] Skipping track {track_id}: Song already exists")
             return False
 
@@ -59,22 +62,23 @@ def process_spotify_track(track_id: str):
 
         peaks = extract_peaks(S_db)
         print(f"[INFO] Extracted {len(peaks)} peaks from spectrogram")
+        # spectrogram is the biggest array in the pipeline and isnt needed past this point
+        del S_db
 
         # 6: fingerprinting
-        fingerprints_tuple, _ = generate_hashes(peaks, track_id)
-        fingerprints = [
-            {
-                "spotify_ID": track_id,
-                "youtube_ID": youtube_id,
-                "hash_value": h,
-                "hash_time": t,
-            }
-            for h, t in fingerprints_tuple
-        ]
-        print(f"[INFO] Generated {len(fingerprints)} fingerprints")
+        (hashes, hash_times), _ = generate_hashes(peaks, track_id)
+        print(f"[INFO] Generated {len(hashes)} fingerprints")
+        del peaks
 
         # 7: save fingerprints to DB
-        save_fingerprints_batch(fingerprints)
+        saved = save_fingerprints_batch(track_id, youtube_id, hashes, hash_times)
+        del hashes, hash_times
+        if not saved:
+            print(f"[ERROR] No fingerprints stored for {track_id}, skipping...")
+            for path in [audio_path, processed_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            return False
 
         # 8: save metadata to DB (so we dont need to call spotify API every time)
         save_song_metadata(track_id, youtube_id, info)
@@ -101,5 +105,11 @@ if __name__ == "__main__":
         "7mykoq6R3BArsSpNDjFQTm",
     ]
 
-    for track_id in ids:
-        process_spotify_track(track_id)
+    # download/ffmpeg dominate per track and release the GIL, so threads overlap them well
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(process_spotify_track, ids))
+
+    # refresh index statistics once the whole batch is in
+    analyze_db()
+
+    print(f"[DONE] Processed {sum(results)}/{len(ids)} tracks")
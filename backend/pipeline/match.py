@@ -1,13 +1,13 @@
 import os
 import uuid
-from collections import Counter
 from engine.preprocessor import preprocessor
 from engine.spectrogram import audio_to_spectrogram
 from engine.fingerprinting import generate_hashes
 from engine.peak_maker import extract_peaks
-from pipeline.db import get_all_fingerprints, get_song
+from pipeline.db import get_offset_match_counts, get_song, get_songs_metadata
 
 TEMP_DIR = "temp"
+TOP_K = 5  # only the best matches get their metadata looked up
 os.makedirs(TEMP_DIR, exist_ok=True)
 
 
@@ -29,9 +29,11 @@ def process_audio_sample(audio_bytes: bytes) -> list:
     return result
 
 
-def get_song_details(spotify_id):
-    """gets song details from the database (cached metadata)"""
-    song_data = get_song(spotify_id)
+def get_song_details(spotify_id, song_data=None):
+    """gets song details from the database (cached metadata)\n
+    **PARAMS:** spotify_id, song_data (already fetched metadata row, skips the lookup)"""
+    if song_data is None:
+        song_data = get_song(spotify_id)
     if not song_data:
         return None
 
@@ -47,12 +49,13 @@ def get_song_details(spotify_id):
     }
 
 
-def match(file_path: str):
+def match(file_path: str, top_k: int = TOP_K):
     """
     matches an audio file against the fingerprint database
 
     Args:
         file_path (str): path to the audio file
+        top_k (int): number of best matches to return
 
     Returns:
         list: list of dicts with 'song_details' and 'confidence', sorted by confidence
@@ -61,20 +64,14 @@ def match(file_path: str):
         print(f"[ERROR] File not found: {file_path}")
         return []
 
-    db_fingerprints = get_all_fingerprints()
-    if not db_fingerprints:
-        print("[ERROR] Database is empty or could not be read.")
-        return []
-
-    print(f"[BACKEND LOG] Fetched {len(db_fingerprints)} fingerprints from the database.")
-
     # generate fingerprints for the input audio file
     processed_path = None
     try:
         processed_path = preprocessor(file_path)
         s_db = audio_to_spectrogram(processed_path)
         peaks = extract_peaks(s_db)
-        input_fingerprints, _ = generate_hashes(peaks, None)
+        del s_db  # free the spectrogram before the DB lookup
+        (input_hashes, input_times), _ = generate_hashes(peaks, None)
     except Exception as e:
         print(f"[ERROR] Could not generate fingerprints for {file_path}: {e}")
         return []
@@ -82,43 +79,36 @@ def match(file_path: str):
         if processed_path and os.path.exists(processed_path):
             os.remove(processed_path)
 
-    if not input_fingerprints:
+    if len(input_hashes) == 0:
         print("[WARN] No fingerprints generated from input audio")
         return []
 
-    print(f"[BACKEND LOG] Generated {len(input_fingerprints)} fingerprints from the input audio.")
-
-    input_fingerprints_with_time = {h: t for h, t in input_fingerprints}
+    print(f"[BACKEND LOG] Generated {len(input_hashes)} fingerprints from the input audio.")
 
-    # group database fingerprints by spotify_ID
-    db_fingerprints_by_song = {}
-    for db_fp in db_fingerprints:
-        spotify_id = db_fp["spotify_ID"]
-        if spotify_id not in db_fingerprints_by_song:
-            db_fingerprints_by_song[spotify_id] = []
-        db_fingerprints_by_song[spotify_id].append((db_fp["hash_value"], db_fp["hash_time"]))
+    # offset histogram and per-song best count are computed inside sqlite, only one row per song comes back
+    match_counts = get_offset_match_counts(input_hashes.tolist(), input_times.tolist())
+    print(f"[BACKEND LOG] Found matching hashes for {len(match_counts)} songs in the database.")
 
     # find potential matches and calculate confidence
+    scores = []
+    for spotify_id, num_matches in match_counts.items():
+        confidence = (num_matches / len(input_hashes)) * 100
+        print(f"[BACKEND LOG] Song {spotify_id}: Found {num_matches} matching hashes. Confidence: {confidence}%")
+        scores.append((spotify_id, confidence))
+
+    scores.sort(key=lambda x: x[1], reverse=True)
+    scores = scores[:top_k]
+
+    # fetch metadata for the surviving matches in one query
+    cached_metadata = get_songs_metadata([spotify_id for spotify_id, _ in scores])
+
     results = []
-    for spotify_id, db_fps in db_fingerprints_by_song.items():
-        time_offsets = []
-        for db_hash, db_time in db_fps:
-            if db_hash in input_fingerprints_with_time:
-                input_time = input_fingerprints_with_time[db_hash]
-                time_offsets.append(db_time - input_time)
-
-        if time_offsets:
-            _, num_matches = Counter(time_offsets).most_common(1)[0]
-            confidence = (num_matches / len(input_fingerprints)) * 100 if len(input_fingerprints) > 0 else 0
-            print(f"[BACKEND LOG] Song {spotify_id}: Found {num_matches} matching hashes. Confidence: {confidence}%")
-
-            song_details = get_song_details(spotify_id)
-            if song_details:
-                results.append({
-                    "song_details": song_details,
-                    "confidence": round(confidence, 2)
-                })
-
-    results.sort(key=lambda x: x["confidence"], reverse=True)
+    for spotify_id, confidence in scores:
+        song_details = get_song_details(spotify_id, cached_metadata.get(spotify_id))
+        if song_details:
+            results.append({
+                "song_details": song_details,
+                "confidence": round(confidence, 2)
+            })
 
     return results
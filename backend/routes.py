@@ -14,7 +14,7 @@ from fastapi import APIRouter, HTTPException, UploadFile, File, Request
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from engine.spotify_parser import extract_spotify_ids
 from pipeline.load import process_spotify_track
-from pipeline.db import get_dashboard, get_song, save_feedback, check_rate_limit
+from pipeline.db import analyze_db, get_dashboard, get_song, save_feedback, check_rate_limit
 from pipeline.match import process_audio_sample
 
 router = APIRouter()
@@ -79,6 +79,10 @@ async def load_tracks(req: LoadRequest, max_workers: int = 5):
             except Exception as e:
                 print(f"[ERROR] Track {tid} failed: {e}")
 
+    # refresh index statistics once the whole batch is in
+    if processed_count:
+        analyze_db()
+
     skipped_count = total_tracks - processed_count
     duration = round(time.time() - start_time, 2)
     average = round(duration / total_tracks, 2) if total_tracks else 0